@@ -1,10 +1,15 @@
+import orjson
 import requests
-from datetime import datetime, date, timedelta
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderUnavailable, GeocoderTimedOut
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
+from urllib3.util.retry import Retry
+from datetime import date, timedelta
+from functools import lru_cache
+import dbm
 import os
+import shelve
+import sqlite3
+import time
 from dotenv import load_dotenv
 
 # Загрузка API ключа из .env файла
@@ -15,31 +20,140 @@ if not API_KEY:
     print("⚠ Ошибка: Не найден API ключ Visual Crossing. Пожалуйста, создайте файл .env с ключом.")
     exit(1)
 
+# Каталог для кэшей геокодинга и ответов API
+CACHE_DIR = os.path.expanduser("~/.cache/cityweather")
+
+# Общая HTTP-сессия: переиспользует TCP/TLS соединения между запросами
+# и кэширует ответы API (прошедшие дни не меняются, поэтому хранятся бессрочно)
+try:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    SESSION = CachedSession(
+        os.path.join(CACHE_DIR, "weather_cache.sqlite"),
+        backend="sqlite",
+        expire_after=3600,
+        ignored_parameters=["key"],
+    )
+except (OSError, sqlite3.Error):
+    # Дисковый кэш недоступен: это не критично, кэшируем только в памяти
+    SESSION = CachedSession(backend="memory", expire_after=3600, ignored_parameters=["key"])
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
 
-def get_coordinates(city):
+# Координаты Уфы, используются по умолчанию и при ошибках геокодинга
+DEFAULT_COORDINATES = (54.7378, 55.9419)
+
+# Дисковый кэш геокодинга: Nominatim разрешает не более 1 запроса в секунду
+GEOCODE_CACHE_PATH = os.path.join(CACHE_DIR, "geocode")
+GEOCODE_CACHE_TTL = 30 * 86400  # 30 дней
+GEOCODE_SEED = {"уфа": DEFAULT_COORDINATES}
+
+
+class GeocodingError(Exception):
+    """Ошибка обращения к сервису геокодинга"""
+
+
+@lru_cache(maxsize=1)
+def _get_geocode():
     """
-    Получает координаты города через Nominatim API.
-    По умолчанию ищет в России, но поддерживает международные города.
-    Возвращает (широта, долгота) или координаты Уфы (54.73780, 55.94188) при ошибке.
+    Создаёт геокодер один раз, чтобы его пул соединений переиспользовался.
+    Возвращает функцию geocode, которая выполняет не более 1 запроса в секунду.
+    """
+    # geopy импортируется лениво: при попадании в кэш он не нужен
+    from geopy.geocoders import Nominatim
+    from geopy.extra.rate_limiter import RateLimiter
+
+    geolocator = Nominatim(user_agent="weather_app", timeout=10)
+    # Ошибки не глушим, иначе сбой сервиса выглядел бы как "город не найден"
+    return RateLimiter(geolocator.geocode, min_delay_seconds=1, max_retries=0, swallow_exceptions=False)
+
+
+def _read_geocode_cache(key):
+    """Возвращает (широта, долгота) из дискового кэша или None"""
+    try:
+        with shelve.open(GEOCODE_CACHE_PATH, flag="r") as cache:
+            entry = cache.get(key)
+    except (OSError, *dbm.error):
+        return None
+
+    if entry is None:
+        return None
+    latitude, longitude, saved_at = entry
+    if time.time() - saved_at > GEOCODE_CACHE_TTL:
+        return None
+    return latitude, longitude
+
+
+def _write_geocode_cache(key, coordinates):
+    """Сохраняет координаты в дисковый кэш; ошибки записи не критичны"""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with shelve.open(GEOCODE_CACHE_PATH) as cache:
+            cache[key] = (*coordinates, time.time())
+    except (OSError, *dbm.error):
+        pass
+
+
+@lru_cache(maxsize=512)
+def _geocode_cached(city_norm):
+    """
+    Ищет координаты по нормализованному названию города.
+    Сначала проверяет встроенные значения и дисковый кэш, затем обращается к Nominatim.
+    Возвращает (широта, долгота) или None, если город не найден.
+    Ошибки сервиса пробрасываются как GeocodingError.
     """
-    # Если города нет в словаре, используем API Nominatim
+    if city_norm in GEOCODE_SEED:
+        return GEOCODE_SEED[city_norm]
+
+    coordinates = _read_geocode_cache(city_norm)
+    if coordinates:
+        return coordinates
+
+    from geopy.exc import GeocoderUnavailable, GeocoderTimedOut
+
+    geocode = _get_geocode()
     try:
-        geolocator = Nominatim(user_agent="weather_app")
+        # Структурированный запрос: Nominatim не разбирает свободный текст
         # Сначала пробуем искать с привязкой к России
-        location = geolocator.geocode(f"{city}, Россия", exactly_one=True)
+        location = geocode({"city": city_norm, "country": "Russia"}, exactly_one=True)
         # Если не найдено в России, ищем без указания страны
         if not location:
-            location = geolocator.geocode(city, exactly_one=True)
+            location = geocode({"city": city_norm}, exactly_one=True)
+        # Запросы вида "Казань, Татарстан" находит только поиск по свободному тексту
+        if not location:
+            location = geocode(city_norm, exactly_one=True)
+    except (GeocoderUnavailable, GeocoderTimedOut, requests.exceptions.RequestException) as e:
+        raise GeocodingError(e) from e
 
-        if location:
-            return location.latitude, location.longitude
-        else:
-            print(f"⚠ Город '{city}' не найден. Используются координаты Уфы.")
-            return 54.73780, 55.94188
+    if not location:
+        return None
 
-    except (GeocoderUnavailable, GeocoderTimedOut, requests.exceptions.RequestException) as e:
+    # 4 знака (~11 м) достаточно для погоды и повышают долю попаданий в кэш
+    coordinates = (round(location.latitude, 4), round(location.longitude, 4))
+    _write_geocode_cache(city_norm, coordinates)
+    return coordinates
+
+
+def get_coordinates(city):
+    """
+    Получает координаты города через Nominatim API с кэшированием результатов.
+    По умолчанию ищет в России, но поддерживает международные города.
+    Возвращает (широта, долгота), округлённые до 4 знаков, или координаты Уфы (54.7378, 55.9419) при ошибке.
+    """
+    try:
+        coordinates = _geocode_cached(city.strip().lower())
+    except GeocodingError as e:
         print(f"⚠ Ошибка геокодинга: {e}. Используются координаты Уфы.")
-        return 54.73780, 55.94188
+        return DEFAULT_COORDINATES
+
+    if coordinates:
+        return coordinates
+    print(f"⚠ Город '{city}' не найден. Используются координаты Уфы.")
+    return DEFAULT_COORDINATES
 
 
 def fetch_weather_data(latitude, longitude, start_date, end_date):
@@ -48,12 +162,26 @@ def fetch_weather_data(latitude, longitude, start_date, end_date):
 
     # Формируем URL запроса
     location = f"{latitude},{longitude}"
-    url = f"{base_url}{location}/{start_date}/{end_date}?unitGroup=metric&include=days&key={API_KEY}&contentType=json"
+    url = f"{base_url}{location}/{start_date}/{end_date}"
+    params = {
+        "unitGroup": "metric",
+        "include": "days",
+        "key": API_KEY,
+        "contentType": "json",
+    }
+
+    # Данные старше двух дней уже не меняются ни в одном часовом поясе
+    immutable = str(end_date) <= (date.today() - timedelta(days=2)).isoformat()
 
     try:
-        response = requests.get(url)
+        response = SESSION.get(url, params=params, timeout=10)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
+
+        # Такие ответы пересохраняем в кэш без срока годности; срок задаём в самом кэше,
+        # а не заголовком запроса, чтобы не отправлять серверу Cache-Control
+        if immutable and not response.from_cache:
+            SESSION.cache.save_response(response, expires=None)
 
         # Обрабатываем данные в едином формате
         processed_data = {
@@ -71,58 +199,72 @@ def fetch_weather_data(latitude, longitude, start_date, end_date):
 
         return processed_data
 
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         print(f"⚠ Ошибка при запросе данных о погоде: {e}")
         return None
 
 
-def plot_weather(data, city):
-    """Строит график температуры с аннотациями и легендой"""
-    if not data or "daily" not in data:
+# Параметры подписей температур на графике
+ANN_KW_MAX = dict(textcoords="offset points", xytext=(0, 10), ha="center", fontsize=9, color="red")
+ANN_KW_MIN = dict(textcoords="offset points", xytext=(0, -15), ha="center", fontsize=9, color="blue")
+
+
+def _to_np(seq):
+    """Преобразует список температур в массив float, заменяя None на NaN"""
+    import numpy as np
+
+    return np.asarray(seq, dtype=np.float64)
+
+
+def plot_weather(data, city, ax=None):
+    """
+    Строит график температуры с аннотациями и легендой.
+    Если передан ax, график перерисовывается на нём вместо создания новой фигуры,
+    а показ фигуры остаётся за вызывающим кодом.
+    """
+    if not data or "daily" not in data or not data["daily"]["time"]:
         print("⚠ Нет данных для построения графика!")
         return
 
-    dates = [datetime.strptime(d, "%Y-%m-%d").date() for d in data["daily"]["time"]]
-    temp_max = data["daily"]["temperature_2m_max"]
-    temp_min = data["daily"]["temperature_2m_min"]
+    # matplotlib импортируется лениво: запрос на одну дату график не строит
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+    import numpy as np
+
+    dates = np.array(data["daily"]["time"], dtype="datetime64[D]").astype(object)
+    temp_max = _to_np(data["daily"]["temperature_2m_max"])
+    temp_min = _to_np(data["daily"]["temperature_2m_min"])
 
-    plt.figure(figsize=(12, 6))
+    owns_figure = ax is None
+    if owns_figure:
+        fig, ax = plt.subplots(figsize=(12, 6))
+    else:
+        fig = ax.figure
+        ax.clear()
 
     # Графики с маркерами
-    max_line, = plt.plot(dates, temp_max, label="Макс. температура", marker="o", color="red", linestyle="-",
-                         linewidth=2)
-    min_line, = plt.plot(dates, temp_min, label="Мин. температура", marker="o", color="blue", linestyle="-",
-                         linewidth=2)
-
-    # Аннотации для максимальной температуры
-    for date_, temp in zip(dates, temp_max):
-        plt.annotate(
-           f"{temp:.1f}°C",
-            (date_, temp),
-            textcoords="offset points",
-            xytext=(0, 10),
-            ha="center",
-            fontsize=9,
-            color="red",
-        )
-
-    # Аннотации для минимальной температуры
-    for date_, temp in zip(dates, temp_min):
-        plt.annotate(
-            f"{temp:.1f}°C",
-            (date_, temp),
-            textcoords="offset points",
-            xytext=(0, -15),
-            ha="center",
-            fontsize=9,
-            color="blue",
-        )
+    max_line, = ax.plot(dates, temp_max, label="Макс. температура", marker="o", color="red", linestyle="-",
+                        linewidth=2)
+    min_line, = ax.plot(dates, temp_min, label="Мин. температура", marker="o", color="blue", linestyle="-",
+                        linewidth=2)
+
+    # Аннотации для максимальной и минимальной температуры за один проход
+    # Подписываем только дни, где известны обе температуры
+    valid = ~(np.isnan(temp_max) | np.isnan(temp_min))
+    valid_dates = dates[valid]
+    valid_max = temp_max[valid]
+    valid_min = temp_min[valid]
+    labels_max = [f"{t:.1f}°C" for t in valid_max]
+    labels_min = [f"{t:.1f}°C" for t in valid_min]
+    for date_, tmax, tmin, label_max, label_min in zip(valid_dates, valid_max, valid_min, labels_max, labels_min):
+        ax.annotate(label_max, (date_, tmax), **ANN_KW_MAX)
+        ax.annotate(label_min, (date_, tmin), **ANN_KW_MIN)
 
     # Заливка между графиками
-    plt.fill_between(dates, temp_min, temp_max, color="lightgray", alpha=0.3, label="Разница температур")
+    ax.fill_between(dates, temp_min, temp_max, color="lightgray", alpha=0.3, label="Разница температур")
 
     # Настройка легенды
-    plt.legend(
+    ax.legend(
         handles=[max_line, min_line],
         loc="upper left",
         framealpha=1,
@@ -131,18 +273,26 @@ def plot_weather(data, city):
     )
 
     # Настройка осей и заголовка
-    plt.title(f"Температура в {city.capitalize()} за последние 7 дней", fontsize=14, pad=20)
-    plt.xlabel("Дата", fontsize=12)
-    plt.ylabel("Температура (°C)", fontsize=12)
-    plt.grid(True, linestyle="--", alpha=0.7)
+    ax.set_title(f"Температура в {city.capitalize()} за последние 7 дней", fontsize=14, pad=20)
+    ax.set_xlabel("Дата", fontsize=12)
+    ax.set_ylabel("Температура (°C)", fontsize=12)
+    ax.grid(True, linestyle="--", alpha=0.7)
 
     # Форматирование дат
-    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter("%d.%m"))
-    plt.gca().xaxis.set_major_locator(mdates.DayLocator())
-    plt.gcf().autofmt_xdate()
-
-    plt.tight_layout()
-    plt.show()
+    ax.xaxis.set_major_formatter(mdates.DateFormatter("%d.%m"))
+    ax.xaxis.set_major_locator(mdates.DayLocator())
+
+    # Показ и раскладку чужой фигуры оставляем вызывающему коду
+    if owns_figure:
+        fig.autofmt_xdate()
+        fig.tight_layout()
+        plt.show()
+    else:
+        # autofmt_xdate действует на всю фигуру, поэтому поворачиваем подписи только этих осей
+        ax.tick_params(axis="x", labelrotation=30)
+        for label in ax.get_xticklabels():
+            label.set_horizontalalignment("right")
+        fig.canvas.draw_idle()
 
 
 def main():
@@ -159,14 +309,14 @@ def main():
     if date_str:
         # Погода на конкретную дату
         try:
-            #target_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-            data = fetch_weather_data(latitude, longitude, date_str, date_str)
+            target_date = date.fromisoformat(date_str).isoformat()
+            data = fetch_weather_data(latitude, longitude, target_date, target_date)
             print(f"Координаты города {city}: {latitude}, {longitude}")
 
             if data and "daily" in data:
                 temp_max = data["daily"]["temperature_2m_max"][0]
                 temp_min = data["daily"]["temperature_2m_min"][0]
-                print(f"\n📅 Погода в {city.capitalize()} на {date_str}:")
+                print(f"\n📅 Погода в {city.capitalize()} на {target_date}:")
                 print(f"🔥 Максимальная температура: {temp_max}°C")
                 print(f"❄️ Минимальная температура: {temp_min}°C")
             else:
@@ -178,7 +328,7 @@ def main():
         end_date = date.today()
         start_date = end_date - timedelta(days=6)  # 7 дней включая сегодня
 
-        data = fetch_weather_data(latitude, longitude, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
+        data = fetch_weather_data(latitude, longitude, start_date.isoformat(), end_date.isoformat())
 
         if data and "daily" in data:
             print(f"Координаты города {city}: {latitude}, {longitude}")